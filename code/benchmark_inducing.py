@@ -0,0 +1,124 @@
+import pdb
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import gpflow
+
+from gpflow.likelihoods import Gaussian
+from gpflow.kernels import SquaredExponential, White
+
+from dgp import DGP
+
+def build_model(X, Y, num_layers, Z, Z_mean=None):
+    kernels = []
+    for l in range(num_layers):
+        kernels.append(SquaredExponential() + White(variance=1e-5))
+
+    dgp_model = DGP(X.shape[1], kernels, Gaussian(variance=0.05), Z,
+            num_outputs=Y.shape[1], num_samples=1, num_data=X.shape[0],
+            mean_inducing_variables=Z_mean)
+
+    # initialise inner layers almost deterministically
+    for layer in dgp_model.layers[:-1]:
+        layer.scale_q_sqrt(1e-5)
+    return dgp_model
+
+def time_per_step(model, X, Y, iterations, learning_rate):
+    """Returns the average wall-clock time of a compiled optimisation step,
+    excluding the first (tracing) step."""
+    optimiser = tf.optimizers.Adam(learning_rate)
+
+    @tf.function
+    def optimisation_step(X, Y):
+        with tf.GradientTape() as tape:
+            obj = - model.elbo(X, Y, full_cov=False)
+        grad = tape.gradient(obj, model.trainable_variables)
+        optimiser.apply_gradients(zip(grad, model.trainable_variables))
+
+    optimisation_step(X, Y)
+    t0 = time.time()
+    for i in range(iterations):
+        optimisation_step(X, Y)
+    return (time.time() - t0) / iterations
+
+def run_config(queue, M, decoupled, args):
+    """Times a dense or decoupled model with M (mean) inducing points. Called
+    in a fresh process so a model that does not fit in memory is killed
+    without taking the benchmark down with it."""
+    # Synthetic data with the shape of the power dataset (D=4), the same
+    # in every process.
+    np.random.seed(0)
+    X = np.random.rand(args.num_data, args.dim_in)
+    Y = np.sin(10 * X).sum(1, keepdims=True) + \
+            0.1 * np.random.randn(args.num_data, 1)
+    Xb, Yb = X[:args.batch_size], Y[:args.batch_size]
+    Z_cov = X[np.random.permutation(args.num_data)[:args.num_inducing]]
+    Z = X[np.random.permutation(args.num_data)[:M]]
+
+    if decoupled:
+        model = build_model(X, Y, args.num_layers, Z_cov, Z_mean=Z)
+    else:
+        model = build_model(X, Y, args.num_layers, Z)
+    queue.put(time_per_step(model, Xb, Yb, args.iterations,
+        args.learning_rate))
+
+def time_in_process(ctx, M, decoupled, args):
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_config, args=(queue, M, decoupled,
+        args))
+    process.start()
+    process.join()
+    if process.exitcode == 0:
+        return queue.get()
+    # The process was killed, usually by the OOM killer.
+    return float('nan')
+
+def main(args):
+    outname = '../tmp/benchmark_inducing_' + str(args.num_layers) + '.time'
+    if not os.path.exists(os.path.dirname(outname)):
+        os.makedirs(os.path.dirname(outname))
+    outfile = open(outname, 'w')
+    outfile.write('M dense decoupled\n')
+
+    ctx = multiprocessing.get_context('spawn')
+    for M in args.Ms:
+        if M <= args.max_dense:
+            t_dense = time_in_process(ctx, M, False, args)
+        else:
+            t_dense = float('nan')
+        t_decoupled = time_in_process(ctx, M, True, args)
+
+        print('M={}: dense {:.4f}s/step, decoupled {:.4f}s/step'.format(M,
+            t_dense, t_decoupled))
+        outfile.write('{} {} {}\n'.format(M, t_dense, t_decoupled))
+        outfile.flush()
+    outfile.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--Ms', type=int, nargs='+',
+        default=[1000, 2000, 5000, 10000],
+        help='Numbers of (mean) inducing points to benchmark.')
+    parser.add_argument('--num_inducing', type=int, default=100,
+        help='Number of covariance inducing points for the decoupled model.')
+    parser.add_argument('--max_dense', type=int, default=2000,
+        help='Largest M to run the dense model for. The dense q_sqrt and '
+        'its optimiser state need several GB beyond M=2000.')
+    parser.add_argument('--num_data', type=int, default=20000,
+        help='Number of synthetic data points.')
+    parser.add_argument('--dim_in', type=int, default=4,
+        help='Input dimension of the synthetic data.')
+    parser.add_argument('--num_layers', type=int, default=2,
+        help='Number of DGP layers.')
+    parser.add_argument('--batch_size', type=int, default=10000,
+        help='Minibatch size.')
+    parser.add_argument('--iterations', type=int, default=20,
+        help='Number of timed optimisation steps.')
+    parser.add_argument('--learning_rate', type=float, default=0.01,
+        help='Learning rate for optimiser.')
+
+    args = parser.parse_args()
+    main(args)
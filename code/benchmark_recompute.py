@@ -0,0 +1,98 @@
+import pdb
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+import numpy as np
+
+def run_config(num_layers, recompute, args):
+    """Trains a DGP for a few steps and returns the time per step and peak
+    memory. Called in a fresh process so peak memory is not shared."""
+    import tensorflow as tf
+    from gpflow.likelihoods import Gaussian
+    from gpflow.kernels import SquaredExponential, White
+    from dgp import DGP
+
+    X = np.random.rand(args.batch_size, args.dim_in)
+    Y = np.sin(10 * X).sum(1, keepdims=True) + \
+            0.1 * np.random.randn(args.batch_size, 1)
+    Z = X[np.random.permutation(args.batch_size)[:args.num_inducing]]
+
+    kernels = []
+    for l in range(num_layers):
+        kernels.append(SquaredExponential() + White(variance=1e-5))
+    model = DGP(X.shape[1], kernels, Gaussian(variance=0.05), Z,
+            num_outputs=Y.shape[1], num_samples=args.num_samples,
+            num_data=X.shape[0], recompute=recompute)
+    for layer in model.layers[:-1]:
+        layer.scale_q_sqrt(1e-5)
+
+    optimiser = tf.optimizers.Adam(0.01)
+
+    @tf.function
+    def optimisation_step(X, Y):
+        with tf.GradientTape() as tape:
+            obj = - model.elbo(X, Y, full_cov=False)
+        grad = tape.gradient(obj, model.trainable_variables)
+        optimiser.apply_gradients(zip(grad, model.trainable_variables))
+
+    optimisation_step(X, Y)
+    t0 = time.time()
+    for i in range(args.iterations):
+        optimisation_step(X, Y)
+    time_per_step = (time.time() - t0) / args.iterations
+
+    # ru_maxrss is in kilobytes on Linux.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return time_per_step, peak_memory
+
+def _run_in_process(queue, num_layers, recompute, args):
+    queue.put(run_config(num_layers, recompute, args))
+
+def main(args):
+    outname = '../tmp/benchmark_recompute_' + str(args.num_samples) + '_'\
+            + str(args.batch_size) + '.time'
+    if not os.path.exists(os.path.dirname(outname)):
+        os.makedirs(os.path.dirname(outname))
+    outfile = open(outname, 'w')
+    outfile.write('layers recompute time memory\n')
+
+    ctx = multiprocessing.get_context('spawn')
+    for num_layers in args.depths:
+        for recompute in [False, True]:
+            queue = ctx.Queue()
+            process = ctx.Process(target=_run_in_process, args=(queue, 
+                num_layers, recompute, args))
+            process.start()
+            process.join()
+            if process.exitcode == 0:
+                t, mem = queue.get()
+            else:
+                # The process was killed, usually by the OOM killer.
+                t, mem = float('nan'), float('nan')
+            print('{} layers, recompute={}: {:.4f}s/step, {:.1f}MB'.format(
+                num_layers, recompute, t, mem))
+            outfile.write('{} {} {} {}\n'.format(num_layers, recompute, t,
+                mem))
+            outfile.flush()
+    outfile.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', type=int, nargs='+',
+        default=[1, 2, 3, 4, 5],
+        help='Numbers of DGP layers to benchmark.')
+    parser.add_argument('--num_inducing', type=int, default=100,
+        help='Number of inducing input locations.')
+    parser.add_argument('--num_samples', type=int, default=10,
+        help='Number of samples to propagate.')
+    parser.add_argument('--batch_size', type=int, default=10000,
+        help='Minibatch size.')
+    parser.add_argument('--dim_in', type=int, default=8,
+        help='Input dimension of the synthetic data.')
+    parser.add_argument('--iterations', type=int, default=10,
+        help='Number of timed optimisation steps.')
+
+    args = parser.parse_args()
+    main(args)
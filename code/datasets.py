@@ -227,6 +227,25 @@ class WineWhite(Dataset):
             csv.writer(f).writerows(data)
 
 
+class SyntheticPower(Dataset):
+    """Synthetic data with the size and input dimension of power, for use
+    when the UCI files cannot be downloaded."""
+    def __init__(self):
+        self.name, self.N, self.D = 'synthetic_power', 9568, 4
+        self.type = 'regression'
+
+    def download_data(self):
+        rng = np.random.RandomState(0)
+        X = rng.rand(self.N, self.D)
+        Y = np.sin(3 * X[:, 0]) + X[:, 1] * X[:, 2] - np.cos(2 * X[:, 3])\
+                + 0.5 * np.sin(6 * X[:, 0] * X[:, 3])\
+                + 0.1 * rng.randn(self.N)
+        data = np.concatenate([X, Y[:, None]], 1)
+
+        with open(self.csv_file_path(self.name), 'w') as f:
+            csv.writer(f).writerows(data)
+
+
 class Datasets(object):
     def __init__(self, data_path='/data/'):
         if not os.path.isdir(data_path):
@@ -243,6 +262,7 @@ class Datasets(object):
         datasets.append(Protein())
         datasets.append(WineRed())
         datasets.append(WineWhite())
+        datasets.append(SyntheticPower())
 
         self.all_datasets = {}
         for d in datasets:
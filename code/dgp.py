@@ -11,18 +11,38 @@ gpflow.config.set_default_float(np.float64)
 gpflow.config.set_default_jitter(1e-6)
 
 class DGPBase(BayesianModel):
-    """Base class for deep gaussian processes."""
+    """Base class for deep gaussian processes.
+
+    :recompute: A bool, if True each layer's forward pass is recomputed
+    during backpropagation instead of keeping its intermediate tensors
+    alive, trading extra compute for memory that no longer grows with the
+    size of the conditional computations in every layer."""
 
     def __init__(self, likelihood, layers, num_samples=10, num_data=None, 
-            **kwargs):
+            recompute=False, **kwargs):
         super().__init__(**kwargs)
 
         self.likelihood = likelihood
         self.layers = layers
         self.num_samples = num_samples # Is this needed here?
         self.num_data = num_data
-
-    def propagate(self, X, full_cov=False, S=1, zs=None):
+        self.recompute = recompute
+
+    def _sample_layer(self, layer, F, z=None, full_cov=False):
+        """Draws a sample from a layer, recomputing its forward pass during
+        backpropagation if self.recompute is set."""
+        if not self.recompute:
+            return layer.sample_from_conditional(F, z=z, full_cov=full_cov)
+
+        # The noise must be an input so the recomputed sample is the same.
+        if z is None:
+            shape = [tf.shape(F)[0], tf.shape(F)[1], layer.num_outputs]
+            z = tf.random.normal(shape, dtype=default_float())
+        sample = lambda F, z: layer.sample_from_conditional(F, z=z, 
+                full_cov=full_cov)
+        return tf.recompute_grad(sample)(F, z)
+
+    def propagate(self, X, full_cov=False, S=1, zs=None, all_layers=True):
         """Propagate input X through layers of the DGP S times. 
 
         :X: A tensor, the input to the DGP.
@@ -30,23 +50,29 @@ class DGPBase(BayesianModel):
         covariance matrix.
         :S: An int, the number of samples to draw.
         :zs: A tensor, samples from N(0,1) to use in the reparameterisation
-        trick."""
+        trick.
+        :all_layers: A bool, if False only the final layer's samples, means
+        and variances are kept and returned (as lists of length one)."""
         sX = tf.tile(tf.expand_dims(X, 0), [S, 1, 1]) # [S,N,D]
         Fs, Fmeans, Fvars = [], [], []
         F = sX
         zs = zs or [None, ] * len(self.layers) # [None, None, ..., None]
         for layer, z in zip(self.layers, zs):
-            F, Fmean, Fvar = layer.sample_from_conditional(F, z=z,
+            F, Fmean, Fvar = self._sample_layer(layer, F, z=z,
                     full_cov=full_cov)
 
-            Fs.append(F)
-            Fmeans.append(Fmean)
-            Fvars.append(Fvar)
+            if all_layers:
+                Fs.append(F)
+                Fmeans.append(Fmean)
+                Fvars.append(Fvar)
 
+        if not all_layers:
+            return [F], [Fmean], [Fvar]
         return Fs, Fmeans, Fvars
 
     def _predict(self, X, full_cov=False, S=1):
-        Fs, Fmeans, Fvars = self.propagate(X, full_cov=full_cov, S=S)
+        Fs, Fmeans, Fvars = self.propagate(X, full_cov=full_cov, S=S,
+                all_layers=False)
         return Fmeans[-1], Fvars[-1]
 
     def E_log_p_Y(self, X, Y, full_cov=False):
@@ -81,6 +107,64 @@ class DGPBase(BayesianModel):
 
         return L * scale - KL
 
+    def stream_update(self, X, Y, iterations=10, learning_rate=0.01,
+            batch_size=None, train_inducing=False, full_cov=False):
+        """Absorbs a new batch of observations with a few warm-started steps
+        instead of retraining from scratch.
+
+        This is streaming variational Bayes: the current posterior becomes
+        the prior, so the objective is the expected log density of the new
+        data minus the KL from each layer's q to its value before the
+        update. Kernel and likelihood hyperparameters are held fixed. If
+        train_inducing is set the old posterior is carried over to the moved
+        inducing points unchanged, which is an approximation.
+
+        Only variable values change, so the model can keep serving
+        predictions between steps. num_data is increased by the number of
+        new observations once the update is done.
+
+        :X: A tensor, the new inputs.
+        :Y: A tensor, the new outputs.
+        :iterations: An int, the number of optimisation steps.
+        :learning_rate: A float, the learning rate for Adam.
+        :batch_size: An int or None, the minibatch size, all of X if None.
+        :train_inducing: A bool, whether to also update the inducing points.
+        :full_cov: A bool, indicates whether or not to use the full
+        covariance matrix."""
+        num_new = X.shape[0]
+        batch_size = num_new if batch_size is None else min(batch_size,
+                num_new)
+        batches = iter(tf.data.Dataset.from_tensor_slices((X, Y)).repeat()\
+                .shuffle(buffer_size=num_new).batch(batch_size))
+
+        # Constant copies of the posterior before the update.
+        q_old = [(tf.convert_to_tensor(layer.q_mean()),
+            tf.identity(layer.q_var_sqrt())) for layer in self.layers]
+        variables = [v for layer in self.layers
+                for v in layer.streaming_variables(train_inducing)]
+        optimiser = tf.optimizers.Adam(learning_rate)
+
+        @tf.function
+        def optimisation_step(X, Y):
+            with tf.GradientTape() as tape:
+                L = tf.reduce_sum(self.E_log_p_Y(X, Y, full_cov))
+                scale = tf.cast(num_new, L.dtype) / tf.cast(tf.shape(X)[0],
+                        L.dtype)
+                KL = tf.add_n([layer.KL_to(m, L_q) for layer, (m, L_q) in
+                    zip(self.layers, q_old)])
+                obj = - (L * scale - KL)
+            grad = tape.gradient(obj, variables)
+            optimiser.apply_gradients(zip(grad, variables))
+            return - obj
+
+        objs = []
+        for i in range(iterations):
+            X_batch, Y_batch = next(batches)
+            objs.append(optimisation_step(X_batch, Y_batch).numpy())
+
+        self.num_data = num_new + (self.num_data or 0)
+        return objs
+
     def elbo(self, X, Y, full_cov=False):
         """ This returns the evidence lower bound (ELBO) of the log 
         marginal likelihood. """
@@ -109,15 +193,19 @@ class DGP(DGPBase):
     each layer."""
     
     def __init__(self, dim_in, kernels, likelihood, inducing_variables, 
-            num_outputs, mean_function=Zero(), white=False, **kwargs):
+            num_outputs, mean_function=Zero(), white=False, q_sqrt_type='full',
+            q_sqrt_rank=1, mean_inducing_variables=None, **kwargs):
 
         layers = self._init_layers(dim_in, kernels, inducing_variables, 
-                num_outputs=num_outputs, mean_function=mean_function, white=white)
+                num_outputs=num_outputs, mean_function=mean_function, white=white,
+                q_sqrt_type=q_sqrt_type, q_sqrt_rank=q_sqrt_rank,
+                mean_inducing_variables=mean_inducing_variables)
 
         super().__init__(likelihood, layers, **kwargs)
         
     def _init_layers(self, dim_in, kernels, inducing_variables, num_outputs=None, 
-            mean_function=Zero(), Layer=SVGPLayer, white=False):
+            mean_function=Zero(), Layer=SVGPLayer, white=False, 
+            q_sqrt_type='full', q_sqrt_rank=1, mean_inducing_variables=None):
         """Initialise DGP layers to have the same number of outputs as inputs,
         apart from the final layer."""
         layers = []
@@ -129,10 +217,13 @@ class DGP(DGPBase):
             # Use Identity mean function when input and output dimensions
             # are the same.
             layers.append(Layer(kern, inducing_variables, dim_in, mf, 
-                white=white))
+                white=white, q_sqrt_type=q_sqrt_type, q_sqrt_rank=q_sqrt_rank,
+                mean_inducing_variables=mean_inducing_variables))
 
         layers.append(Layer(kernels[-1], inducing_variables, num_outputs,
-            mean_function, white=white))
+            mean_function, white=white, q_sqrt_type=q_sqrt_type, 
+            q_sqrt_rank=q_sqrt_rank, 
+            mean_inducing_variables=mean_inducing_variables))
         return layers
 
             
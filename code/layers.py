@@ -93,105 +93,313 @@ class SVGPLayer(Layer):
     The layer holds D_out independent GPs with the same kernel and inducing
     points.
 
+    The covariance of q(u) can be parameterised in one of three ways:
+    'full'    - a separate lower triangular q_sqrt per output. [D_out,M,M]
+    'shared'  - a single lower triangular q_sqrt for all outputs. [1,M,M]
+    'lowrank' - q_var = L(diag(q_diag^2) + q_factor q_factor^T)L^T per
+                output, with q_diag [D_out,M] and q_factor [D_out,M,R].
+                This is always in whitened coordinates (L = I if white),
+                since a low rank plus diagonal matrix cannot represent the
+                correlations in k(Z,Z).
+    The 'shared' and 'lowrank' options keep memory at O(M^2) rather than
+    O(D_out M^2), which matters for layers with many outputs.
+
+    If mean_inducing_variables is given, the layer uses a decoupled basis
+    (Cheng & Boots, 2017). The mean is m(X) = k(X,Z_a)q_alpha over a
+    separate, typically much larger, set Z_a while the covariance is the
+    usual sparse GP covariance over inducing_variables. The mean and its KL
+    contribution cost O(N M_a) and O(M_a^2) rather than O(M_a^3), so
+    M_a can be in the thousands while the covariance set stays small.
+
     :kernel: A gpflow.kernel, the kernel for the layer.
     :inducing_variables: A tensor, the inducing points. [M,D_in]
     :num_outputs: The number of GP outputs.
     :mean_function: A gpflow.mean_function, the mean function for the layer.
+    :q_sqrt_type: A string, one of 'full', 'shared' or 'lowrank'.
+    :q_sqrt_rank: An int, the rank R of q_factor when q_sqrt_type='lowrank'.
+    :mean_inducing_variables: A tensor or None, the inducing points for the
+    decoupled mean. [M_a,D_in]
     """
 
     def __init__(self, kernel, inducing_variables, num_outputs, mean_function,
-            input_prop_dim=None, white=False, **kwargs):
+            input_prop_dim=None, white=False, q_sqrt_type='full', 
+            q_sqrt_rank=1, mean_inducing_variables=None, **kwargs):
         super().__init__(input_prop_dim, **kwargs)
 
-        self.num_inducing = inducing_variables.shape[0]
-
-        # Initialise q_mu to all zeros
-        q_mu = np.zeros((self.num_inducing, num_outputs))
-        self.q_mu = Parameter(q_mu, dtype=default_float())
+        if q_sqrt_type not in ['full', 'shared', 'lowrank']:
+            raise ValueError('Unknown q_sqrt_type: {}'.format(q_sqrt_type))
 
-        # Initialise q_sqrt to identity function
-        #q_sqrt = tf.tile(tf.expand_dims(tf.eye(self.num_inducing, 
-        #    dtype=default_float()), 0), (num_outputs, 1, 1))
-        q_sqrt = [np.eye(self.num_inducing, dtype=default_float()) for _ in 
-                range(num_outputs)]
-        q_sqrt = np.array(q_sqrt)
-        # Store as lower triangular matrix L.
-        self.q_sqrt = Parameter(q_sqrt, transform=triangular())
+        self.num_inducing = inducing_variables.shape[0]
 
         self.inducing_points = inducingpoint_wrapper(inducing_variables)
+        self.decoupled = mean_inducing_variables is not None
+
+        if self.decoupled:
+            self.num_mean_inducing = mean_inducing_variables.shape[0]
+            self.mean_inducing_points = inducingpoint_wrapper(
+                    mean_inducing_variables)
+            # Initialise the mean weights to all zeros
+            q_alpha = np.zeros((self.num_mean_inducing, num_outputs))
+            self.q_alpha = Parameter(q_alpha, dtype=default_float())
+            self.q_mu = None
+        else:
+            # Initialise q_mu to all zeros
+            q_mu = np.zeros((self.num_inducing, num_outputs))
+            self.q_mu = Parameter(q_mu, dtype=default_float())
 
         self.kernel = kernel
         self.mean_function = mean_function
         self.num_outputs = num_outputs
         self.white = white
+        self.q_sqrt_type = q_sqrt_type
+        self.q_sqrt_rank = q_sqrt_rank
 
-        # Initialise to prior (Ku) + jitter.
-        if not self.white:
+        # Initialise to prior, identity if whitened and Ku + jitter otherwise.
+        if self.white:
+            Lu = np.eye(self.num_inducing, dtype=default_float())
+        else:
             Ku = self.kernel.K(inducing_variables)
             Lu = np.linalg.cholesky(Ku + np.eye(self.num_inducing) * 
                     default_jitter())
-            #q_sqrt = tf.tile(tf.expand_dims(Lu, 0), (num_outputs, 1, 1))
-            q_sqrt = [Lu for _ in range(num_outputs)]
-            q_sqrt = np.array(q_sqrt)
+
+        if self.q_sqrt_type == 'lowrank':
+            # Start at the (whitened) prior, with the low rank factor close
+            # to (but not at) zero so that it receives non-zero gradients.
+            q_diag = np.ones((num_outputs, self.num_inducing))
+            self.q_diag = Parameter(q_diag, transform=positive())
+            q_factor = 1e-3 * np.random.randn(num_outputs, self.num_inducing,
+                    self.q_sqrt_rank)
+            self.q_factor = Parameter(q_factor, dtype=default_float())
+            self.q_sqrt = None
+        else:
+            num_q_sqrt = num_outputs if self.q_sqrt_type == 'full' else 1
+            q_sqrt = np.array([Lu for _ in range(num_q_sqrt)])
+            # Store as lower triangular matrix L.
             self.q_sqrt = Parameter(q_sqrt, transform=triangular())
 
+    def scale_q_sqrt(self, factor):
+        """Scales the square root of the variational covariance, e.g. to
+        initialise inner layers almost deterministically.
+
+        :factor: A float, the scale applied to the square root."""
+        if self.q_sqrt_type == 'lowrank':
+            self.q_diag = Parameter(self.q_diag.numpy() * factor, 
+                    transform=positive())
+            self.q_factor = Parameter(self.q_factor.numpy() * factor,
+                    dtype=default_float())
+        else:
+            self.q_sqrt = Parameter(self.q_sqrt.numpy() * factor, 
+                    transform=triangular())
+
+    def q_mean(self):
+        """The variational mean parameter, q_alpha if decoupled and q_mu
+        otherwise."""
+        return self.q_alpha if self.decoupled else self.q_mu
+
+    def q_var_sqrt(self):
+        """The lower triangular square root of the variational covariance
+        for each output. [D_out,M,M]"""
+        M = self.num_inducing
+        if self.q_sqrt_type == 'lowrank':
+            q_var = tf.linalg.diag(tf.square(self.q_diag)) + tf.matmul(
+                    self.q_factor, self.q_factor, transpose_b=True)
+            q_var_sqrt = tf.linalg.cholesky(q_var)
+            if not self.white:
+                Kmm = Kuu(self.inducing_points, self.kernel, 
+                        jitter=default_jitter())
+                Lmm = tf.linalg.cholesky(Kmm)
+                q_var_sqrt = tf.matmul(Lmm[None, :, :], q_var_sqrt)
+            return q_var_sqrt
+        return tf.broadcast_to(self.q_sqrt, [self.num_outputs, M, M])
+
+    def streaming_variables(self, train_inducing=False):
+        """The variables updated when absorbing new data, see 
+        DGPBase.stream_update.
+
+        :train_inducing: A boolean, whether to include the inducing points."""
+        params = [self.q_mean()]
+        if self.q_sqrt_type == 'lowrank':
+            params += [self.q_diag, self.q_factor]
+        else:
+            params += [self.q_sqrt]
+        if train_inducing:
+            params += [self.inducing_points]
+            if self.decoupled:
+                params += [self.mean_inducing_points]
+        return [v for p in params for v in p.trainable_variables]
+
+    def _q_var_terms(self, A, full_cov=False):
+        """Computes alpha(X)^T q_var alpha(X) for each output.
+
+        :A: A tensor, alpha(X) of shape [M,N]. For 'lowrank' this must be
+        the whitened L^{-1}k(Z,X), whatever the value of self.white.
+        :full_cov: A boolean, whether to return [D,N,N] or just the
+        diagonal [D,N]. With a shared q_sqrt the leading dimension is 1."""
+        if self.q_sqrt_type == 'lowrank':
+            # Diagonal part, alpha(X)^T diag(q_diag^2) alpha(X)
+            if full_cov:
+                DA = self.q_diag[:, :, None] * A[None, :, :] # [D_out,M,N]
+                var = tf.matmul(DA, DA, transpose_a=True) # [D_out,N,N]
+            else:
+                var = tf.matmul(tf.square(self.q_diag), tf.square(A))
+            # Low rank part, q_factor^T alpha(X) is [D_out,R,N]
+            WtA = tf.matmul(self.q_factor, A[None, :, :], transpose_a=True)
+        else:
+            # q_sqrt^T alpha(X) is [D_out,M,N], or [1,M,N] if shared.
+            WtA = tf.matmul(self.q_sqrt, A[None, :, :], transpose_a=True)
+            var = 0.
+
+        if full_cov:
+            return var + tf.matmul(WtA, WtA, transpose_a=True)
+        else:
+            return var + tf.reduce_sum(tf.square(WtA), 1)
+
     def conditional_ND(self, X, full_cov=False):
-        # X is [S,N,D]
+        # X is [N,D]
         Kmm = Kuu(self.inducing_points, self.kernel, jitter=default_jitter())
         Lmm = tf.linalg.cholesky(Kmm)
-        Kmm_tiled = tf.tile(tf.expand_dims(Kmm, 0), (self.num_outputs, 1, 1))
-        Lmm_tiled = tf.tile(tf.expand_dims(Lmm, 0), (self.num_outputs, 1, 1))
 
         Kmn = Kuf(self.inducing_points, self.kernel, X) # K(Z,X)
         # alpha(X) = k(Z,Z)^{-1}k(Z,X), = L^{-T}L^{-1}k(Z,X)
         A = tf.linalg.triangular_solve(Lmm, Kmn, lower=True) # L^{-1}k(Z,X)
-        if not self.white:
-            # L^{-T}L^{-1}K(Z,X) is [M,N]
-            A = tf.linalg.triangular_solve(tf.transpose(Lmm), A, lower=False)
-        
-        # m = alpha(X)^T(q_mu - m(Z)) = alpha(X)^T(q_mu) if zero mean function.
-        mean = tf.matmul(A, self.q_mu, transpose_a=True) # [N]
-        
-        # [D_out,M,N]
-        A_tiled = tf.tile(A[None, :, :], [self.num_outputs, 1, 1]) 
-        I = tf.eye(self.num_inducing, dtype=default_float())[None, :, :]
-       
+
         # var = k(X,X) - alpha(X)^T(k(Z,Z)-q_sqrtq_sqrt^T)alpha(X)
-        if self.white:
-            SK = -I
+        # The prior term alpha(X)^Tk(Z,Z)alpha(X) = A^TA with A = L^{-1}k(Z,X)
+        # in both representations, so it is computed once for all outputs.
+        if full_cov:
+            Knn = self.kernel.K(X) - tf.matmul(A, A, transpose_a=True) # [N,N]
         else:
-            # -k(Z,Z)
-            SK = -Kmm_tiled # [D_out,M,M]
+            Knn = self.kernel.K_diag(X) - tf.reduce_sum(tf.square(A), 0) # [N]
 
-        if self.q_sqrt is not None:
-            # SK = -k(Z,Z) + q_sqrtq_sqrt^T
-            # [D_out,M,M]
-            SK += tf.matmul(self.q_sqrt, self.q_sqrt, transpose_b=True) 
-        
-        # B = -(k(Z,Z) - q_sqrtq_sqrt^T)alpha(X)
-        B = tf.matmul(SK, A_tiled) # [D_out,M,N]
+        # The low rank covariance is always whitened.
+        A_var = A
 
-        if full_cov:
-            # delta_cov = -alpha(X)^T(k(Z,Z) - q_sqrtq_sqrt^T)alpha(X)
-            delta_cov = tf.matmul(A_tiled, B, transpose_a=True) # [D_out,N,N]
-            # Knn = k(X,X)
-            Knn = self.kernel.K(X)
+        if not self.white:
+            # L^{-T}L^{-1}K(Z,X) is [M,N]
+            A = tf.linalg.triangular_solve(tf.transpose(Lmm), A, lower=False)
+            if self.q_sqrt_type != 'lowrank':
+                A_var = A
+        
+        if self.decoupled:
+            # m = k(X,Z_a)q_alpha, linear in M_a.
+            Kan = Kuf(self.mean_inducing_points, self.kernel, X) # [M_a,N]
+            mean = tf.matmul(Kan, self.q_alpha, transpose_a=True) # [N,D_out]
         else:
-            # Summing over dimension 1 --> sum variances due to other.
-            # Is this legit?
-            delta_cov = tf.reduce_sum(A_tiled * B, 1)
-            #delta_cov = tf.linalg.diag_part(tf.matmul(A_tiled, B, 
-            #    transpose_a=True)) # [D_out,N]
-            Knn = self.kernel.K_diag(X) # [N]
-       
-        var = tf.expand_dims(Knn, 0) + delta_cov # [D_out,N]
+            # m = alpha(X)^T(q_mu - m(Z)) = alpha(X)^T(q_mu) if zero mean 
+            # function.
+            mean = tf.matmul(A, self.q_mu, transpose_a=True) # [N,D_out]
+
+        # [D_out,N] or [D_out,N,N]
+        var = tf.expand_dims(Knn, 0) + self._q_var_terms(A_var, 
+                full_cov=full_cov)
+        if self.q_sqrt_type == 'shared':
+            multiples = [self.num_outputs, 1, 1] if full_cov else \
+                    [self.num_outputs, 1]
+            var = tf.tile(var, multiples)
         var = tf.transpose(var)
         
         return mean + self.mean_function(X), var
 
     def KL(self):
         """The KL divergence from variational distribution to the prior."""
-        return kullback_leiblers.prior_kl(self.inducing_points, self.kernel,
-                self.q_mu, self.q_sqrt, whiten=self.white)
-
+        if not self.decoupled:
+            return self._inducing_kl(self.q_mu)
+
+        # Decoupled basis: 0.5 q_alpha^T k(Z_a,Z_a) q_alpha plus the KL of
+        # the covariance part with zero mean.
+        Kaa = Kuu(self.mean_inducing_points, self.kernel)
+        mean_kl = 0.5 * tf.reduce_sum(self.q_alpha * tf.matmul(Kaa, 
+            self.q_alpha))
+        q_mu = tf.zeros((self.num_inducing, self.num_outputs), 
+                dtype=default_float())
+        return mean_kl + self._inducing_kl(q_mu)
+
+    def _inducing_kl(self, q_mu):
+        """KL[N(q_mu, q_var) || p(u)] over inducing_points.
+
+        :q_mu: A tensor, the variational mean. [M,D_out]"""
+        if self.q_sqrt_type == 'full':
+            return kullback_leiblers.prior_kl(self.inducing_points, 
+                    self.kernel, q_mu, self.q_sqrt, whiten=self.white)
+
+        M, D = self.num_inducing, self.num_outputs
+        if self.white:
+            alpha = q_mu
+        else:
+            Kmm = Kuu(self.inducing_points, self.kernel, 
+                    jitter=default_jitter())
+            Lmm = tf.linalg.cholesky(Kmm)
+            alpha = tf.linalg.triangular_solve(Lmm, q_mu, lower=True)
+
+        mahalanobis = tf.reduce_sum(tf.square(alpha))
+        constant = -tf.cast(M * D, default_float())
+
+        if self.q_sqrt_type == 'shared':
+            # The same covariance is counted once per output.
+            Lq = self.q_sqrt[0]
+            logdet_q = D * tf.reduce_sum(tf.math.log(tf.square(
+                tf.linalg.diag_part(Lq))))
+            if not self.white:
+                Lq = tf.linalg.triangular_solve(Lmm, Lq, lower=True)
+            trace = D * tf.reduce_sum(tf.square(Lq))
+        else:
+            d2 = tf.square(self.q_diag) # [D_out,M]
+            W = self.q_factor # [D_out,M,R]
+            # Matrix determinant lemma:
+            # |diag(d2) + WW^T| = |diag(d2)||I + W^Tdiag(d2)^{-1}W|
+            I = tf.eye(self.q_sqrt_rank, dtype=default_float())[None, :, :]
+            C = I + tf.matmul(W / d2[:, :, None], W, transpose_a=True)
+            logdet_q = tf.reduce_sum(tf.math.log(d2)) + 2. * tf.reduce_sum(
+                    tf.math.log(tf.linalg.diag_part(tf.linalg.cholesky(C))))
+            # The covariance is whitened, so log|k(Z,Z)| cancels and
+            # tr(k(Z,Z)^{-1}q_var) = tr(diag(q_diag^2) + q_factor q_factor^T).
+            trace = tf.reduce_sum(d2) + tf.reduce_sum(tf.square(W))
+
+        twoKL = mahalanobis + constant - logdet_q + trace
+        if not self.white and self.q_sqrt_type != 'lowrank':
+            twoKL += D * tf.reduce_sum(tf.math.log(tf.square(
+                tf.linalg.diag_part(Lmm))))
+        return 0.5 * twoKL
+
+    def KL_to(self, q_mean_old, q_var_sqrt_old):
+        """The KL divergence from the variational distribution to a previous
+        one, which acts as the prior when absorbing new data.
+
+        :q_mean_old: A tensor, the previous q_mean(). [M,D_out] or [M_a,D_out]
+        :q_var_sqrt_old: A tensor, the previous q_var_sqrt(). [D_out,M,M]"""
+        M, D = self.num_inducing, self.num_outputs
+        L = self.q_var_sqrt()
+        LiL = tf.linalg.triangular_solve(q_var_sqrt_old, L, lower=True)
+        trace = tf.reduce_sum(tf.square(LiL))
+        logdet = tf.reduce_sum(tf.math.log(tf.square(tf.linalg.diag_part(
+            q_var_sqrt_old)))) - tf.reduce_sum(tf.math.log(tf.square(
+                tf.linalg.diag_part(L))))
+
+        diff = self.q_mean() - q_mean_old
+        if self.decoupled:
+            # The RKHS norm, as in KL, plus a correction at the covariance
+            # inducing points so the old posterior's precision is used:
+            # (K_ba diff)^T (S_old^{-1} - K_bb^{-1}) (K_ba diff).
+            Kaa = Kuu(self.mean_inducing_points, self.kernel)
+            mahalanobis = tf.reduce_sum(diff * tf.matmul(Kaa, diff))
+            Kba = Kuf(self.inducing_points, self.kernel, 
+                    self.mean_inducing_points.Z) # [M,M_a]
+            Kmm = Kuu(self.inducing_points, self.kernel, 
+                    jitter=default_jitter())
+            Lmm = tf.linalg.cholesky(Kmm)
+            u = tf.matmul(Kba, diff) # [M,D_out]
+            v = tf.linalg.triangular_solve(Lmm, u, lower=True)
+            if self.white:
+                # In the whitened representation K_bb^{-1} becomes I.
+                u = v
+            u = tf.transpose(u)[:, :, None] # [D_out,M,1]
+            mahalanobis += tf.reduce_sum(tf.square(
+                tf.linalg.triangular_solve(q_var_sqrt_old, u, lower=True)))\
+                - tf.reduce_sum(tf.square(v))
+        else:
+            diff = tf.transpose(diff)[:, :, None] # [D_out,M,1]
+            mahalanobis = tf.reduce_sum(tf.square(tf.linalg.triangular_solve(
+                q_var_sqrt_old, diff, lower=True)))
 
+        constant = -tf.cast(M * D, default_float())
+        return 0.5 * (trace + mahalanobis + constant + logdet)
@@ -0,0 +1,237 @@
+import pdb
+import numpy as np
+import tensorflow as tf
+import gpflow
+from gpflow.covariances import Kuu
+from gpflow.kernels import SquaredExponential, White, Sum
+from gpflow.likelihoods import Gaussian
+from gpflow.mean_functions import Identity, Zero
+from gpflow.config import default_float, default_jitter
+from dgp import DGP
+
+gpflow.config.set_default_float(np.float64)
+gpflow.config.set_default_jitter(1e-6)
+
+def _se_parameters(kernel):
+    """Returns the variance and lengthscales of the squared exponential part
+    of a kernel, and the total variance of any White kernels added to it.
+
+    :kernel: A gpflow.kernel, either SquaredExponential or a Sum of one
+    SquaredExponential and White kernels."""
+    if isinstance(kernel, SquaredExponential):
+        return kernel.variance, kernel.lengthscales, 0.
+    if isinstance(kernel, Sum):
+        se = [k for k in kernel.kernels if isinstance(k, SquaredExponential)]
+        white = [k for k in kernel.kernels if isinstance(k, White)]
+        if len(se) == 1 and len(se) + len(white) == len(kernel.kernels):
+            white_var = tf.add_n([k.variance for k in white]) if white else 0.
+            return se[0].variance, se[0].lengthscales, white_var
+    raise NotImplementedError('Moment matching requires a SquaredExponential '
+            'kernel, optionally plus White kernels.')
+
+def psi_statistics(kernel, Z, mean, var):
+    """Expectations of the kernel under diagonal Gaussian inputs,
+    h ~ N(mean, var).
+
+        psi0[n] = E[k(h_n,h_n)]
+        psi1[n,m] = E[k(h_n,z_m)]
+        psi2[n,m,m'] = E[k(z_m,h_n)k(h_n,z_m')]
+
+    :kernel: A gpflow.kernel, see _se_parameters.
+    :Z: A tensor, the inducing points [M,D].
+    :mean: A tensor, the input means [N,D].
+    :var: A tensor, the input variances [N,D]."""
+    variance, lengthscales, white_var = _se_parameters(kernel)
+    l2 = tf.square(lengthscales) * tf.ones_like(Z[0]) # [D]
+    M, D = tf.shape(Z)[0], tf.shape(Z)[1]
+
+    psi0 = (variance + white_var) * tf.ones_like(mean[:, 0]) # [N]
+
+    denom1 = l2 + var # [N,D]
+    diff = mean[:, None, :] - Z[None, :, :] # [N,M,D]
+    log_psi1 = -0.5 * tf.reduce_sum(tf.square(diff) / denom1[:, None, :], 2)\
+            - 0.5 * tf.reduce_sum(tf.math.log(denom1 / l2), 1)[:, None]
+    psi1 = variance * tf.exp(log_psi1) # [N,M]
+
+    # Expand (mean - Zbar)^2 to avoid an [N,M,M,D] intermediate.
+    denom2 = l2 + 2. * var # [N,D]
+    Zbar = tf.reshape(0.5 * (Z[:, None, :] + Z[None, :, :]), [M * M, D])
+    dist = tf.reduce_sum(tf.square(mean) / denom2, 1)[:, None]\
+            - 2. * tf.matmul(mean / denom2, Zbar, transpose_b=True)\
+            + tf.matmul(1. / denom2, tf.square(Zbar), transpose_b=True)
+    dZ = tf.reduce_sum(tf.square(Z[:, None, :] - Z[None, :, :]) / l2, 2)
+    log_psi2 = -0.25 * tf.reshape(dZ, [1, M * M]) - dist\
+            - 0.5 * tf.reduce_sum(tf.math.log(denom2 / l2), 1)[:, None]
+    psi2 = tf.square(variance) * tf.reshape(tf.exp(log_psi2), [-1, M, M])
+    return psi0, psi1, psi2
+
+class PowerEPDGP(DGP):
+    """A DGP trained with approximate Power EP (Bui et al., 2016) instead of
+    doubly stochastic variational inference. The layers, and so the
+    variational parameters q_mu and q_sqrt, are the same as for DGP. The
+    approximate posterior q(u) at each layer is p(u)t(u)^N for a tied site
+    t(u), and inputs are propagated through the layers by moment matching
+    rather than sampling.
+
+    log_likelihood returns the approximate EP energy, which is maximised
+    with the same optimisers as the variational bound. As alpha -> 0 the
+    energy tends to the variational bound with moment matched propagation.
+
+    :alpha: A float in (0,1], the power EP parameter."""
+
+    def __init__(self, dim_in, kernels, likelihood, inducing_variables,
+            num_outputs, alpha=0.5, **kwargs):
+        super().__init__(dim_in, kernels, likelihood, inducing_variables,
+                num_outputs, **kwargs)
+
+        if not isinstance(likelihood, Gaussian):
+            raise NotImplementedError('Power EP requires a Gaussian '
+                    'likelihood.')
+        for layer in self.layers:
+            if layer.decoupled:
+                raise NotImplementedError('Power EP does not support '
+                        'decoupled inducing points.')
+        self.alpha = alpha
+
+    def _posterior(self, layer):
+        """Returns k(Z,Z) and q(u) in the unwhitened representation, with
+        mean [M,D_out] and covariance [D_out,M,M]."""
+        Kmm = Kuu(layer.inducing_points, layer.kernel, jitter=default_jitter())
+        if layer.q_sqrt_type == 'lowrank':
+            S = tf.linalg.diag(tf.square(layer.q_diag)) + tf.matmul(
+                    layer.q_factor, layer.q_factor, transpose_b=True)
+        else:
+            S = tf.matmul(layer.q_sqrt, layer.q_sqrt, transpose_b=True)
+        m = layer.q_mu
+        Lmm = tf.linalg.cholesky(Kmm)
+        if layer.white:
+            m = tf.matmul(Lmm, m)
+        # The low rank covariance is always whitened.
+        if layer.white or layer.q_sqrt_type == 'lowrank':
+            S = tf.matmul(tf.matmul(Lmm[None, :, :], S), Lmm[None, :, :],
+                    transpose_b=True)
+        M = layer.num_inducing
+        S = tf.broadcast_to(S, [layer.num_outputs, M, M])
+        S += default_jitter() * tf.eye(M, dtype=default_float())[None, :, :]
+        return Kmm, m, S
+
+    def _cavity(self, m, S, Kmm, r):
+        """Removes a fraction r of the tied site from q(u) = N(m,S).
+
+        Returns the cavity mean [M,D_out] and covariance [D_out,M,M], and
+        the log normalisers of q(u) and the cavity.
+
+        :m: A tensor, the mean of q(u) [M,D_out].
+        :S: A tensor, the covariance of q(u) [D_out,M,M].
+        :Kmm: A tensor, the prior covariance k(Z,Z) [M,M].
+        :r: A float, alpha / N."""
+        D, M = tf.shape(S)[0], tf.shape(S)[1]
+        I = tf.eye(M, batch_shape=[D], dtype=default_float())
+        m_D = tf.transpose(m)[:, :, None] # [D_out,M,1]
+
+        # Natural parameters of q(u)
+        L_S = tf.linalg.cholesky(S)
+        S_inv = tf.linalg.cholesky_solve(L_S, I)
+        eta = tf.linalg.cholesky_solve(L_S, m_D)
+        log_norm = tf.reduce_sum(tf.math.log(tf.linalg.diag_part(L_S)))\
+                + 0.5 * tf.reduce_sum(m_D * eta)
+
+        # Cavity natural parameters, (1-r)*q + r*prior
+        K_inv = tf.linalg.cholesky_solve(tf.linalg.cholesky(Kmm), I[0])
+        prec_c = (1. - r) * S_inv + r * K_inv[None, :, :]
+        eta_c = (1. - r) * eta
+        L_c = tf.linalg.cholesky(prec_c)
+        S_c = tf.linalg.cholesky_solve(L_c, I)
+        m_c = tf.linalg.cholesky_solve(L_c, eta_c)
+        log_norm_c = -tf.reduce_sum(tf.math.log(tf.linalg.diag_part(L_c)))\
+                + 0.5 * tf.reduce_sum(eta_c * m_c)
+
+        return tf.transpose(m_c[:, :, 0]), S_c, log_norm, log_norm_c
+
+    def _propagate_layer(self, layer, mean_in, var_in, m, S):
+        """Moment matches the output of a layer given diagonal Gaussian
+        inputs N(mean_in, var_in) and u ~ N(m,S).
+
+        :mean_in: A tensor, the input means [N,D_in].
+        :var_in: A tensor, the input variances [N,D_in].
+        :m: A tensor, the mean of u [M,D_out].
+        :S: A tensor, the covariance of u [D_out,M,M]."""
+        Z = layer.inducing_points.Z
+        psi0, psi1, psi2 = psi_statistics(layer.kernel, Z, mean_in, var_in)
+
+        Kmm = Kuu(layer.inducing_points, layer.kernel, jitter=default_jitter())
+        Lmm = tf.linalg.cholesky(Kmm)
+        K_inv = tf.linalg.cholesky_solve(Lmm,
+                tf.eye(layer.num_inducing, dtype=default_float()))
+        a = tf.linalg.cholesky_solve(Lmm, m) # k(Z,Z)^{-1}m, [M,D_out]
+
+        # E[f] = psi1 k(Z,Z)^{-1}m
+        mean = tf.matmul(psi1, a) # [N,D_out]
+        # E[f^2] = psi0 + tr(psi2 (K^{-1}SK^{-1} - K^{-1} + aa^T))
+        a_D = tf.transpose(a)
+        B = tf.matmul(tf.matmul(K_inv[None, :, :], S), K_inv[None, :, :])\
+                - K_inv[None, :, :] + a_D[:, :, None] * a_D[:, None, :]
+        var = psi0[:, None] + tf.einsum('nmk,dmk->nd', psi2, B)\
+                - tf.square(mean)
+
+        if isinstance(layer.mean_function, Identity):
+            # Add the input, including its covariance with f,
+            # cov(h,f) = sum_m a_m E[(h - mean_in)k(h,z_m)].
+            _, lengthscales, _ = _se_parameters(layer.kernel)
+            l2 = tf.square(lengthscales) * tf.ones_like(Z[0])
+            scaled = var_in / (l2 + var_in)
+            cov = scaled * (tf.matmul(psi1, a * Z) - mean_in * mean)
+            mean = mean + mean_in
+            var = var + var_in + 2. * cov
+        elif not isinstance(layer.mean_function, Zero):
+            raise NotImplementedError('Moment matching requires a Zero or '
+                    'Identity mean function.')
+
+        return mean, tf.maximum(var, default_jitter())
+
+    def _log_tilted(self, mean, var, Y):
+        """log E[p(y|f)^alpha] under f ~ N(mean, var), for each output."""
+        alpha = tf.cast(self.alpha, default_float())
+        noise = self.likelihood.variance
+        return 0.5 * (1. - alpha) * tf.math.log(2. * np.pi * noise)\
+                - 0.5 * tf.math.log(alpha)\
+                - 0.5 * tf.math.log(2. * np.pi * (var + noise / alpha))\
+                - 0.5 * tf.square(Y - mean) / (var + noise / alpha)
+
+    def log_likelihood(self, X, Y, full_cov=False, num_batches=None):
+        """Gives the approximate Power EP energy."""
+        if full_cov:
+            raise NotImplementedError('Power EP propagates diagonal '
+                    'moments only.')
+        if self.num_data is not None:
+            num_data = tf.cast(self.num_data, default_float())
+        else:
+            num_data = tf.cast(tf.shape(X)[0], default_float())
+        alpha = tf.cast(self.alpha, default_float())
+        r = alpha / num_data
+
+        energy = tf.cast(0., default_float())
+        mean, var = X, tf.zeros_like(X)
+        for layer in self.layers:
+            Kmm, m, S = self._posterior(layer)
+            m_c, S_c, log_norm, log_norm_c = self._cavity(m, S, Kmm, r)
+            log_norm_prior = layer.num_outputs * tf.reduce_sum(tf.math.log(
+                tf.linalg.diag_part(tf.linalg.cholesky(Kmm))))
+            energy += log_norm - log_norm_prior\
+                    + (log_norm_c - log_norm) / r
+            mean, var = self._propagate_layer(layer, mean, var, m_c, S_c)
+
+        log_tilted = tf.reduce_sum(self._log_tilted(mean, var, Y), 1)
+        return energy + num_data / alpha * tf.reduce_mean(log_tilted)
+
+    def _predict(self, X, full_cov=False, S=1):
+        """Moment matched prediction under q(u). The returned moments have a
+        leading sample dimension of 1 to match DGPBase."""
+        if full_cov:
+            raise NotImplementedError('Power EP propagates diagonal '
+                    'moments only.')
+        mean, var = X, tf.zeros_like(X)
+        for layer in self.layers:
+            Kmm, m, S_u = self._posterior(layer)
+            mean, var = self._propagate_layer(layer, mean, var, m, S_u)
+        return mean[None, :, :], var[None, :, :]
@@ -14,8 +14,7 @@ import gpflow
 from pathlib import Path
 from gpflow.likelihoods import Gaussian
 from gpflow.kernels import SquaredExponential, White
-from gpflow.utilities import print_summary, triangular
-from gpflow.base import Parameter
+from gpflow.utilities import print_summary
 from scipy.cluster.vq import kmeans2
 from scipy.stats import norm
 from scipy.special import logsumexp
@@ -43,7 +42,20 @@ def main(args):
         print('Getting dataset...')
         data = datasets.all_datasets[args.dataset].get_data(i)
         X, Y, Xs, Ys, Y_std = [data[_] for _ in ['X', 'Y', 'Xs', 'Ys', 'Y_std']]
+        if args.stream_chunks > 1:
+            # Train on the first chunk and absorb the rest as a stream.
+            X_stream = np.array_split(X, args.stream_chunks)
+            Y_stream = np.array_split(Y, args.stream_chunks)
+            X, Y = X_stream.pop(0), Y_stream.pop(0)
+        else:
+            X_stream, Y_stream = [], []
         Z = kmeans2(X, args.num_inducing, minit='points')[0]
+        if args.num_mean_inducing > 0:
+            # kmeans is too slow for thousands of centres, subsample X.
+            idx = np.random.permutation(X.shape[0])[:args.num_mean_inducing]
+            Z_mean = X[idx]
+        else:
+            Z_mean = None
 
         # set up batches
         batch_size = args.M if args.M < X.shape[0] else X.shape[0]
@@ -59,12 +71,13 @@ def main(args):
 
         dgp_model = DGP(X.shape[1], kernels, Gaussian(variance=0.05), Z, 
                 num_outputs=Y.shape[1], num_samples=args.num_samples,
-                num_data=X.shape[0])
+                num_data=X.shape[0], q_sqrt_type=args.q_sqrt_type,
+                q_sqrt_rank=args.q_sqrt_rank, mean_inducing_variables=Z_mean,
+                recompute=args.recompute)
 
         # initialise inner layers almost deterministically
         for layer in dgp_model.layers[:-1]:
-            layer.q_sqrt = Parameter(layer.q_sqrt.value() * 1e-5, 
-                    transform = triangular())
+            layer.scale_q_sqrt(1e-5)
 
         optimiser = tf.optimizers.Adam(args.learning_rate)
 
@@ -94,6 +107,10 @@ def main(args):
         monitored_training_loop(dgp_model, train_dataset, logdir=args.log_dir, 
                 iterations=args.iterations, 
                 logging_iter_freq=args.logging_iter_freq)
+        for X_new, Y_new in zip(X_stream, Y_stream):
+            dgp_model.stream_update(X_new, Y_new, 
+                    iterations=args.stream_iterations,
+                    learning_rate=args.learning_rate, batch_size=args.M)
         t1 = time.time()
         print('Time taken to train: {}'.format(t1 - t0))
         outfile2.write('Split {}: {}\n'.format(i+1, t1-t0))
@@ -140,6 +157,20 @@ if __name__ == '__main__':
         help='Minibatch size.')
     parser.add_argument('--test_samples', type=int, default=100, 
         help='Number of test samples to use.')
+    parser.add_argument('--q_sqrt_type', default='full', 
+        choices=['full', 'shared', 'lowrank'],
+        help='Parameterisation of the variational covariance.')
+    parser.add_argument('--q_sqrt_rank', type=int, default=1,
+        help='Rank of the low rank variational covariance factor.')
+    parser.add_argument('--num_mean_inducing', type=int, default=0,
+        help='Number of decoupled mean inducing points (0 to disable).')
+    parser.add_argument('--recompute', action='store_true',
+        help='Recompute layer forward passes during backpropagation.')
+    parser.add_argument('--stream_chunks', type=int, default=1,
+        help='Number of chunks to split the training data into, training on '
+        'the first and streaming the rest.')
+    parser.add_argument('--stream_iterations', type=int, default=100,
+        help='Number of optimisation steps per streamed chunk.')
 
     args = parser.parse_args()
     main(args)